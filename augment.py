@@ -0,0 +1,132 @@
+# %%
+import math
+import random
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Whole-volume augmentation. The albumentations configs from train_cnn.py are only
+# read for their parameters: those are sampled once per series and every op is
+# applied to the full (S, H, W) stack at once instead of slice by slice.
+# Transforms without a volume op fall back to the per-slice do_aug path.
+
+
+def center_crop(imgs, t):
+    h, w = imgs.shape[1:]
+    y, x = (h - t.height) // 2, (w - t.width) // 2
+    return imgs[:, y:y + t.height, x:x + t.width]
+
+
+def random_crop(imgs, t):
+    h, w = imgs.shape[1:]
+    y, x = random.randint(0, h - t.height), random.randint(0, w - t.width)
+    return imgs[:, y:y + t.height, x:x + t.width]
+
+
+def hflip(imgs, t):
+    return imgs[:, :, ::-1]
+
+
+def vflip(imgs, t):
+    return imgs[:, ::-1, :]
+
+
+def brightness_contrast(imgs, t):
+    alpha = 1.0 + random.uniform(*t.contrast_limit)
+    beta = random.uniform(*t.brightness_limit)
+    # volumes are min-max scaled to 0-255 before augmentation
+    beta = beta * 255 if t.brightness_by_max else beta * imgs.mean()
+    return imgs * alpha + beta
+
+
+def shift_scale_rotate(imgs, t):
+    shift_x = getattr(t, 'shift_limit_x', getattr(t, 'shift_limit', (0, 0)))
+    shift_y = getattr(t, 'shift_limit_y', getattr(t, 'shift_limit', (0, 0)))
+    return affine(imgs, t,
+                  angle=random.uniform(*t.rotate_limit),
+                  scale=random.uniform(*t.scale_limit),
+                  dx=random.uniform(*shift_x),
+                  dy=random.uniform(*shift_y))
+
+
+def rotate(imgs, t):
+    return affine(imgs, t, angle=random.uniform(*t.limit))
+
+
+def affine(imgs, t, angle=0.0, scale=1.0, dx=0.0, dy=0.0):
+    # same matrix as cv2.getRotationMatrix2D + shift, expressed in the normalized
+    # output -> input coordinates affine_grid expects, shared by all slices
+    s, h, w = imgs.shape
+    a = math.radians(angle)
+    fwd = scale * np.array([[math.cos(a), math.sin(a)],
+                            [-math.sin(a), math.cos(a)]])
+    d = np.diag([w / 2, h / 2])
+    m = np.linalg.inv(d) @ np.linalg.inv(fwd) @ d
+    b = -m @ np.array([2 * dx, 2 * dy])
+    theta = torch.as_tensor(np.hstack([m, b[:, None]]), dtype=torch.float32)
+
+    x = torch.as_tensor(np.ascontiguousarray(imgs), dtype=torch.float32).unsqueeze(1)
+    grid = F.affine_grid(theta.expand(s, 2, 3), x.shape, align_corners=False)
+    x = F.grid_sample(x, grid,
+                      mode='nearest' if t.interpolation == 0 else 'bilinear',
+                      padding_mode=PADDING.get(t.border_mode, 'reflection'),
+                      align_corners=False)
+    return x.squeeze(1).numpy()
+
+
+# cv2 border modes -> grid_sample padding modes
+PADDING = {0: 'zeros', 1: 'border'}
+
+VOL_OPS = {'CenterCrop': center_crop,
+           'RandomCrop': random_crop,
+           'HorizontalFlip': hflip,
+           'VerticalFlip': vflip,
+           'RandomBrightnessContrast': brightness_contrast,
+           'ShiftScaleRotate': shift_scale_rotate,
+           'Rotate': rotate}
+
+
+def vol_aug(imgs, transf):
+    if hasattr(transf, 'transforms'):  # A.Compose
+        if random.random() >= getattr(transf, 'p', 1.0):
+            return imgs
+        transf = transf.transforms
+
+    for t in transf:
+        op = VOL_OPS.get(type(t).__name__)
+        if op is None:
+            from utils import do_aug
+            imgs = np.stack(do_aug(imgs, [t]))
+        elif getattr(t, 'always_apply', False) or random.random() < t.p:
+            imgs = op(imgs, t)
+
+    return imgs  # (S, H, W), crops and flips return strided views
+
+
+VIEW_OPS = {'CenterCrop', 'RandomCrop', 'HorizontalFlip', 'VerticalFlip'}
+
+
+def is_view_only(transf):
+    # True if every op just returns a view, so the pipeline works on any dtype
+    # and commutes with a linear intensity transform
+    if transf is None:
+        return True
+    return all(type(t).__name__ in VIEW_OPS
+               for t in getattr(transf, 'transforms', transf))
+
+
+DETERMINISTIC = {'CenterCrop', 'Resize', 'PadIfNeeded', 'Normalize', 'ToFloat'}
+
+
+def is_deterministic(transf):
+    # True if the pipeline gives the same output every time it is applied
+    if transf is None:
+        return True
+    if hasattr(transf, 'transforms'):
+        if getattr(transf, 'p', 1.0) not in (0, 1):
+            return False
+        transf = transf.transforms
+    return all(t.p == 0 or (type(t).__name__ in DETERMINISTIC
+                            and (t.p >= 1 or getattr(t, 'always_apply', False)))
+               for t in transf)
@@ -0,0 +1,189 @@
+# %%
+import argparse
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from dataset import MRDS, collate_cases
+from pack import pack_path, pack_stage
+
+# Throughput benchmarks on a synthetic MRNet-layout dataset, CPU friendly:
+#   python bench.py --out bench_results.json
+# writes one json record per measurement so runs can be diffed.
+
+PLANES = ['axial', 'sagittal', 'coronal']
+
+
+def make_synthetic(datadir,
+                   n_cases={'train': 32, 'valid': 16},
+                   diagnoses=['acl', 'meniscus', 'abnormal'],
+                   img_size=256,
+                   slices=(17, 52),
+                   seed=0):
+    # {stage}-{diagnosis}.csv + {stage}/{plane}/{id}.npy uint8 volumes with a
+    # random slice count per case and plane, like MRNet
+    rng = np.random.default_rng(seed)
+    os.makedirs(datadir, exist_ok=True)
+    case_id = 0
+    for stage, n in n_cases.items():
+        ids = [f'{case_id + i:04d}' for i in range(n)]
+        case_id += n
+        for diagnosis in diagnoses:
+            lbls = rng.integers(0, 2, n)
+            lbls[:2] = [0, 1]  # both classes present
+            with open(f'{datadir}/{stage}-{diagnosis}.csv', 'w') as f:
+                f.writelines(f'{id},{lbl}\n' for id, lbl in zip(ids, lbls))
+        for plane in PLANES:
+            os.makedirs(f'{datadir}/{stage}/{plane}', exist_ok=True)
+            for id in ids:
+                n_slices = rng.integers(slices[0], slices[1] + 1)
+                vol = rng.normal(60, 45, (n_slices, img_size, img_size))
+                np.save(f'{datadir}/{stage}/{plane}/{id}.npy',
+                        np.clip(vol, 0, 255).astype(np.uint8))
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {'mean_s': float(np.mean(times)), 'p50_s': float(np.median(times)),
+            'min_s': float(np.min(times))}
+
+
+def bench_getitem(datadir, transf, repeat=3, **ds_kwargs):
+    ds = MRDS(datadir, 'train', 'acl', transf, PLANES, **ds_kwargs)
+
+    def run():
+        for i in range(len(ds)):
+            ds[i]
+    res = timeit(run, repeat)
+    res['cases_per_s'] = len(ds) / res['mean_s']
+    return res
+
+
+def bench_dataloader(datadir, transf, num_workers, batch_size=4, repeat=2, **ds_kwargs):
+    # the first epoch includes worker start-up, like every epoch in training
+    ds = MRDS(datadir, 'train', 'acl', transf, PLANES, **ds_kwargs)
+    dl = DataLoader(ds, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                    collate_fn=collate_cases)
+
+    def run():
+        for _ in dl:
+            pass
+    res = timeit(run, repeat)
+    res['cases_per_s'] = len(ds) / res['mean_s']
+    return res
+
+
+def fake_batch(batch_size, n_planes, n_slices=32, img_size=224, n_chans=1):
+    imgs = [torch.randn(batch_size * n_slices, n_chans, img_size, img_size)
+            for _ in range(n_planes)]
+    n = [torch.full((batch_size,), n_slices, dtype=torch.long) for _ in range(n_planes)]
+    return (imgs, n), torch.ones(batch_size, 1)
+
+
+def bench_model(backbone, n_planes, batch_size=2, repeat=3, **model_kwargs):
+    from model import MRKnee
+    import torch.nn.functional as F
+    model = MRKnee(backbone=backbone, pretrained=False, planes=PLANES[:n_planes],
+                   **model_kwargs)
+    x, label = fake_batch(batch_size, n_planes)
+
+    def forward():
+        with torch.no_grad():
+            model(x)
+
+    def backward():
+        loss = F.binary_cross_entropy_with_logits(model(x), label)
+        loss.backward()
+        model.zero_grad()
+
+    model.eval()
+    forward()  # warm up
+    res = {'forward': timeit(forward, repeat)}
+    model.train()
+    res['forward_backward'] = timeit(backward, repeat)
+    return res
+
+
+def save_checkpoints(ckpt_dir, diagnosis, backbone):
+    # untrained checkpoints in the layout get_preds expects
+    import pytorch_lightning as pl
+    from model import MRKnee
+    os.makedirs(ckpt_dir, exist_ok=True)
+    for plane in PLANES:
+        model = MRKnee(backbone=backbone, pretrained=False, planes=[plane])
+        torch.save({'state_dict': model.state_dict(),
+                    'pytorch-lightning_version': pl.__version__},
+                   f'{ckpt_dir}{diagnosis}_{plane}.ckpt')
+
+
+def bench_get_preds(datadir, ckpt_dir, backbone, batch_size=4, repeat=1):
+    from utils import get_preds
+    return timeit(lambda: get_preds(datadir, 'acl', 'valid', PLANES, ckpt_dir,
+                                    [backbone] * len(PLANES), device='cpu',
+                                    batch_size=batch_size, cache_dir=None), repeat)
+
+
+# %%
+if __name__ == '__main__':
+    import albumentations as A
+
+    parser = argparse.ArgumentParser(description='MRKnee throughput benchmarks')
+    parser.add_argument('--datadir', default='bench_data')
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--backbones', nargs='+', default=['efficientnet_b0'])
+    parser.add_argument('--workers', nargs='+', type=int, default=[0, 2, 4])
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--skip', nargs='*', default=[],
+                        choices=['getitem', 'dataloader', 'model', 'get_preds'])
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    if not os.path.exists(f'{args.datadir}/valid-acl.csv'):
+        make_synthetic(args.datadir)
+
+    transf = {'train': A.Compose([A.CenterCrop(224, 224), A.HorizontalFlip()]),
+              'valid': A.Compose([A.CenterCrop(224, 224)])}
+    results = []
+
+    def record(name, config, res):
+        results.append({'bench': name, 'config': config, 'result': res})
+        print(name, config, res)
+
+    if 'getitem' not in args.skip:
+        if not os.path.exists(pack_path(args.datadir, 'train')):
+            pack_stage(args.datadir, 'train', PLANES)
+        for storage in ['npy', 'packed']:
+            record('getitem', {'storage': storage},
+                   bench_getitem(args.datadir, transf, storage=storage))
+    if 'dataloader' not in args.skip:
+        for num_workers in args.workers:
+            record('dataloader', {'num_workers': num_workers},
+                   bench_dataloader(args.datadir, transf, num_workers))
+    if 'model' not in args.skip:
+        for backbone in args.backbones:
+            for n_planes in [1, 3]:
+                record('model', {'backbone': backbone, 'n_planes': n_planes},
+                       bench_model(backbone, n_planes))
+    if 'get_preds' not in args.skip:
+        for backbone in args.backbones:
+            ckpt_dir = f'{args.datadir}/models/{backbone}/'
+            save_checkpoints(ckpt_dir, 'acl', backbone)
+            record('get_preds', {'backbone': backbone},
+                   bench_get_preds(args.datadir, ckpt_dir, backbone))
+
+    with open(args.out, 'w') as f:
+        json.dump({'host': {'platform': platform.platform(),
+                            'torch': torch.__version__,
+                            'threads': torch.get_num_threads()},
+                   'results': results}, f, indent=2)
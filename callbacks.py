@@ -0,0 +1,44 @@
+# %%
+import time
+
+import pytorch_lightning as pl
+
+from timing import StageTimer, summarize
+
+
+class StageTimingCallback(pl.Callback):
+    # attaches one StageTimer to the model and the datamodule's datasets and logs
+    # per-stage p50/p95 and training samples/sec to the trainer's loggers
+    def __init__(self, timer=None):
+        self.timer = timer or StageTimer()
+
+    def setup(self, trainer, pl_module, stage=None):
+        pl_module.timer = self.timer
+        dm = trainer.datamodule
+        if dm is not None:
+            dm.train_ds.timer = self.timer
+            dm.val_ds.timer = self.timer
+
+    def on_train_epoch_start(self, trainer, pl_module, *args):
+        self.timer.collect()
+        self.n_samples = 0
+        self.t_start = self.t_end = None
+
+    def on_train_batch_start(self, trainer, pl_module, batch, *args):
+        if self.t_start is None:
+            self.t_start = time.perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, *args):
+        self.n_samples += len(batch[2])
+        self.t_end = time.perf_counter()
+        self.timer.drain()
+
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, *args):
+        self.timer.drain()
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        metrics = {f'time/{k}': v for k, v in summarize(self.timer.collect()).items()}
+        if self.t_start is not None and self.t_end > self.t_start:
+            metrics['time/train_samples_per_s'] = self.n_samples / (self.t_end - self.t_start)
+        if trainer.logger is not None and metrics:
+            trainer.logger.log_metrics(metrics, step=trainer.global_step)
@@ -1,93 +1,13 @@
 # %%
-import torch
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import pytorch_lightning as pl
-import numpy as np
-import csv
-
-from torch.utils.data.sampler import WeightedRandomSampler
-from utils import do_aug
-# %%
-
-
-class MRDS(Dataset):
-    def __init__(self, datadir,
-                 stage,
-                 diagnosis,
-                 transf=None,
-                 planes=['axial', 'sagittal', 'coronal'],
-                 n_chans=1,
-                 indp_normalz=True,
-                 w_loss=True,):
-        super().__init__()
-        self.stage = stage
-        self.datadir = datadir
-        self.planes = planes
-        self.n_chans = n_chans
-        self.transf = transf
-        self.diagnosis = diagnosis
-        self.indp_normalz = indp_normalz
-        self.w_loss = w_loss
-
-        # get cases
-        with open(f'{datadir}/{stage}-{diagnosis}.csv', "r") as f:
-            self.cases = [(row[0], int(row[1]))
-                          for row in list(csv.reader(f))]
-
-        if w_loss:
-            lbls = [lbl for _, lbl in self.cases]
-            pos_count = np.sum(lbls)
-            neg_count = len(lbls) - pos_count
-            self.weight = torch.as_tensor(
-                neg_count / pos_count, dtype=torch.float32).unsqueeze(0)
-
-    def __getitem__(self, index):
-
-        id, label = self.cases[index]
-
-        imgs = [self.prep_imgs(id, plane)
-                for plane in self.planes]
-
-        label = torch.as_tensor(label, dtype=torch.float32).unsqueeze(0)
-
-        return imgs, label, id, self.weight
-
-    def prep_imgs(self, id, plane):
-        path = f'{self.datadir}/{self.stage}/{plane}/{id}.npy'
-        imgs = np.load(path)
-
-        # transforms
-        imgs = (imgs - imgs.min()) / (imgs.max() - imgs.min()) * 255
-
-        if self.transf:
-            imgs = do_aug(imgs, self.transf[self.stage])
-
-        imgs = torch.as_tensor(imgs, dtype=torch.float32)
-
-        # normalize
-        if self.indp_normalz:
-            if plane == 'axial':
-                MEAN, SD = 66.4869, 60.8146
-            elif plane == 'sagittal':
-                MEAN, SD = 60.0440, 48.3106
-            elif plane == 'coronal':
-                MEAN, SD = 61.9277, 64.2818
-        else:
-            MEAN, SD = 58.09, 49.73
-
-        imgs = (imgs - MEAN)/SD
-
-        if self.n_chans == 1:
-            imgs = imgs.unsqueeze(1)
-        else:
-            imgs = torch.stack((imgs,)*3, axis=1)
-
-        return imgs
-
-    def __len__(self):
-        return len(self.cases)
-
+from functools import partial
 
+from dataset import MRDS, FeatureDS, collate_cases
+from sampling import LossStore, HardExampleSampler, DistributedHardExampleSampler, ShardSampler
+from shmcache import VolumeCache
 # %%
 
 class MRKneeDataModule(pl.LightningDataModule):
@@ -101,50 +21,108 @@ class MRKneeDataModule(pl.LightningDataModule):
                  n_chans=1,
                  w_loss=True,
                  indp_normalz=False,
+                 storage='npy',
+                 batch_size=1,
+                 feature_dir=None,
+                 norm_stats=None,
+                 cache_bytes=0,
+                 tensor_cache=None,
+                 n_slices=None,
+                 slice_mode='uniform',
+                 epoch_len=None,  # samples per epoch with upsample, default one pass
+                 hardness=1.0,  # 0 for plain class balancing
                  ** kwargs):
         super().__init__()
         self.kwargs = kwargs
+        self.batch_size = batch_size
         self.upsample = upsample
         self.w_loss = w_loss
         self.indp_normalz = indp_normalz
 
         assert(self.upsample != self.w_loss)
 
-        self.train_ds = MRDS(datadir,
+        ds_cls = partial(FeatureDS, feature_dir) if feature_dir else MRDS
+        self.train_ds = ds_cls(datadir,
                              'train',
                              diagnosis,
                              transf,
                              planes,
                              n_chans,
                              w_loss=w_loss,
-                             indp_normalz=self.indp_normalz)
-        self.val_ds = MRDS(datadir,
-                           'valid',
-                           diagnosis,
-                           transf,
-                           planes,
-                           n_chans,
-                           w_loss=w_loss,
-                           indp_normalz=self.indp_normalz)
+                             indp_normalz=self.indp_normalz,
+                             storage=storage,
+                             norm_stats=norm_stats,
+                             tensor_cache=tensor_cache,
+                             n_slices=n_slices,
+                             slice_mode=slice_mode)
+        self.val_ds = ds_cls(datadir,
+                             'valid',
+                             diagnosis,
+                             transf,
+                             planes,
+                             n_chans,
+                             w_loss=w_loss,
+                             indp_normalz=self.indp_normalz,
+                             storage=storage,
+                             norm_stats=norm_stats,
+                             tensor_cache=tensor_cache,
+                             n_slices=n_slices,
+                             slice_mode=slice_mode)
+        if cache_bytes:
+            # split the byte budget between the stages by number of cases
+            n_cases = len(self.train_ds) + len(self.val_ds)
+            for ds in (self.train_ds, self.val_ds):
+                ds.cache = VolumeCache(cache_bytes * len(ds) // n_cases,
+                                       len(ds) * len(planes))
+        # per case losses, filled in by MRKnee
+        self.loss_store = LossStore(self.train_ds.case_idx)
+        self.val_loss_store = LossStore(self.val_ds.case_idx)
         if self.upsample:
-            lbls = [lbl for _, lbl in self.train_ds.cases]
-            class_counts = np.bincount(lbls)
-            class_weights = 1 / torch.Tensor(class_counts)
-            samples_weight = [class_weights[t] for t in lbls]
-            self.sampler = WeightedRandomSampler(samples_weight, 1)
+            lbls = self.train_ds.labels[:, 0]  # balance on the first diagnosis
+            self.sampler = HardExampleSampler(lbls, self.loss_store,
+                                              num_samples=epoch_len, hardness=hardness)
 
     def train_dataloader(self):
+        if _distributed():
+            self._check_samplers_kept()
+            if self.upsample:
+                sampler = DistributedHardExampleSampler(
+                    self.sampler.labels, self.loss_store, self.sampler.num_samples,
+                    self.sampler.hardness)
+            else:
+                sampler = DistributedSampler(self.train_ds, shuffle=True)
+            return DataLoader(self.train_ds, batch_size=self.batch_size,
+                              sampler=sampler, collate_fn=collate_cases, **self.kwargs)
         if self.upsample:
-            trainloader = DataLoader(self.train_ds, batch_size=1,
-                                     sampler=self.sampler, **self.kwargs)
+            trainloader = DataLoader(self.train_ds, batch_size=self.batch_size,
+                                     sampler=self.sampler, collate_fn=collate_cases,
+                                     **self.kwargs)
         else:
-            trainloader = DataLoader(self.train_ds, batch_size=1,
-                                     shuffle=True, **self.kwargs)
+            trainloader = DataLoader(self.train_ds, batch_size=self.batch_size,
+                                     shuffle=True, collate_fn=collate_cases,
+                                     **self.kwargs)
 
         return trainloader
 
     def val_dataloader(self):
-        return DataLoader(self.val_ds, batch_size=1, shuffle=False, **self.kwargs)
+        if _distributed():  # every rank validates its own shard of the cases
+            self._check_samplers_kept()
+            return DataLoader(self.val_ds, batch_size=self.batch_size,
+                              sampler=ShardSampler(len(self.val_ds)),
+                              collate_fn=collate_cases, **self.kwargs)
+        return DataLoader(self.val_ds, batch_size=self.batch_size, shuffle=False,
+                          collate_fn=collate_cases, **self.kwargs)
+
+    def _check_samplers_kept(self):
+        # Lightning would swap in a padded DistributedSampler, which drops the
+        # class balancing and counts validation cases twice
+        trainer = getattr(self, 'trainer', None)
+        assert not getattr(trainer, 'replace_sampler_ddp', False), \
+            'run distributed with Trainer(replace_sampler_ddp=False)'
+
+
+def _distributed():
+    return dist.is_available() and dist.is_initialized()
 
 
 # %%
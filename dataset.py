@@ -0,0 +1,302 @@
+# %%
+import torch
+from torch.utils.data import Dataset
+import numpy as np
+import csv
+import hashlib
+import os
+import random
+from contextlib import nullcontext
+
+from augment import is_deterministic, is_view_only, vol_aug
+from pack import open_pack, pack_path, read_entry, read_index
+from features import feature_path
+from stats import NORM_STATS, load_stats
+# %%
+
+
+def normalize_volume(imgs, mean, sd, lo, hi, out=None):
+    # ((imgs - lo) / (hi - lo) * 255 - mean) / sd without float64 temporaries
+    scale = 255 / float(hi - lo) / sd
+    if out is None:
+        out = np.empty(imgs.shape, dtype=np.float32)
+    np.multiply(imgs, np.float32(scale), out=out, dtype=np.float32)
+    out += np.float32(-lo * scale - mean / sd)
+    return out
+
+
+def prep_volume(imgs, mean, sd, crop=None, n_chans=1):
+    # the MRDS preprocessing without transforms for a single raw volume, for
+    # scoring outside a dataset -> (S, n_chans, H, W)
+    lo, hi = float(imgs.min()), float(imgs.max())
+    if crop:
+        h, w = imgs.shape[1:]
+        y, x = (h - crop) // 2, (w - crop) // 2
+        imgs = imgs[:, y:y + crop, x:x + crop]
+    imgs = torch.from_numpy(normalize_volume(imgs, mean, sd, lo, hi)).unsqueeze(1)
+    return imgs if n_chans == 1 else imgs.expand(-1, n_chans, -1, -1)
+
+
+def select_slices(n_total, k, mode='uniform', rand=False):
+    # indices of at most k slices; the random modes only sample when rand is set
+    if not k or n_total <= k:
+        return None
+    if mode == 'uniform' or (mode == 'random' and not rand):
+        return np.linspace(0, n_total - 1, k).round().astype(np.int64)
+    if mode == 'random':
+        return np.array(sorted(random.sample(range(n_total), k)))
+    if mode == 'center':
+        start = (n_total - k) // 2
+        return np.arange(start, start + k)
+    if mode == 'stride':
+        step = n_total // k
+        last_start = n_total - 1 - (k - 1) * step
+        start = random.randint(0, last_start) if rand else last_start // 2
+        return np.arange(start, start + k * step, step)
+    raise ValueError(f'unknown slice_mode {mode}')
+
+
+class MRDS(Dataset):
+    def __init__(self, datadir,
+                 stage,
+                 diagnosis,
+                 transf=None,
+                 planes=['axial', 'sagittal', 'coronal'],
+                 n_chans=1,
+                 indp_normalz=True,
+                 w_loss=True,
+                 storage='npy',
+                 norm_stats=None,
+                 tensor_cache=None,
+                 n_slices=None,  # cap on slices per plane, None keeps all
+                 slice_mode='uniform',  # uniform, random, center or stride
+                 random_slices=None,  # defaults to stage == 'train'
+                 n_views=1):  # >1: that many augmented views per plane, for TTA
+        super().__init__()
+        self.stage = stage
+        self.datadir = datadir
+        self.planes = planes
+        self.n_chans = n_chans
+        self.transf = transf
+        self.diagnosis = diagnosis
+        self.indp_normalz = indp_normalz
+        self.w_loss = w_loss
+        self.storage = storage
+        self.norm_stats = load_stats(norm_stats) if norm_stats else NORM_STATS
+        self.n_slices = n_slices
+        self.slice_mode = slice_mode
+        self.random_slices = stage == 'train' if random_slices is None else random_slices
+        self.n_views = n_views
+
+        # packed storage - memmap is opened lazily so every worker maps it itself
+        if storage == 'packed':
+            self.pack_index = read_index(pack_path(datadir, stage))
+        self.pack = None
+        self.cache = None  # VolumeCache, set by MRKneeDataModule(cache_bytes=...)
+        self.timer = None  # timing.StageTimer, set by callbacks.StageTimingCallback
+
+        # a deterministic stage pipeline gives the same tensors every epoch, so
+        # they are saved after the first pass and memory-mapped from then on.
+        # The directory is set on first use, once it is known whether the
+        # uint8 VolumeCache feeds the pipeline
+        self.tensor_cache = tensor_cache if self.is_deterministic() and n_views == 1 else None
+        self.tensor_dir = None
+
+        # get cases - with several diagnoses the label files are joined per case
+        diagnoses = [diagnosis] if isinstance(diagnosis, str) else list(diagnosis)
+        case_lbls = {}
+        for diag in diagnoses:
+            with open(f'{datadir}/{stage}-{diag}.csv', "r") as f:
+                for row in csv.reader(f):
+                    case_lbls.setdefault(row[0], []).append(int(row[1]))
+        case_lbls = {id: lbls for id, lbls in case_lbls.items()
+                     if len(lbls) == len(diagnoses)}
+        self.labels = np.array(list(case_lbls.values()), dtype=np.int64)  # (N, n_diagnoses)
+        if isinstance(diagnosis, str):
+            self.cases = [(id, lbls[0]) for id, lbls in case_lbls.items()]
+        else:
+            self.cases = [(id, tuple(lbls)) for id, lbls in case_lbls.items()]
+        self.case_idx = {id: i for i, (id, _) in enumerate(self.cases)}
+
+        if w_loss:
+            pos_count = self.labels.sum(0)
+            neg_count = len(self.labels) - pos_count
+            self.weight = torch.as_tensor(
+                neg_count / pos_count, dtype=torch.float32)  # per diagnosis
+        else:  # pos_weight of 1 is the unweighted loss, e.g. with upsample
+            self.weight = torch.ones(self.labels.shape[1])
+
+    def __getitem__(self, index):
+
+        id, label = self.cases[index]
+
+        imgs = [self.prep_imgs(id, plane)
+                for plane in self.planes]
+
+        label = torch.as_tensor(self.labels[index], dtype=torch.float32)
+
+        if self.timer:
+            self.timer.flush()
+        return imgs, label, id, self.weight
+
+    def is_deterministic(self):
+        random_sel = (self.n_slices and self.random_slices
+                      and self.slice_mode in ('random', 'stride'))
+        return not random_sel and is_deterministic(
+            self.transf[self.stage] if self.transf else None)
+
+    def timed(self, stage):
+        return self.timer(f'{self.stage}/{stage}') if self.timer else nullcontext()
+
+    def load_imgs(self, id, plane):
+        if self.storage == 'packed':
+            if self.pack is None:
+                self.pack = open_pack(pack_path(self.datadir, self.stage),
+                                      self.pack_index)
+            return read_entry(self.pack, self.pack_index, f'{plane}/{id}')
+        return np.load(f'{self.datadir}/{self.stage}/{plane}/{id}.npy')
+
+    def load_raw(self, id, plane):
+        # -> volume + the min/max it still has to be scaled with to get 0-255
+        if self.cache is None:
+            imgs = self.load_imgs(id, plane)
+            return imgs, float(imgs.min()), float(imgs.max())
+
+        # cached volumes are kept min-max scaled and rounded to uint8
+        key = self.case_idx[id] * len(self.planes) + self.planes.index(plane)
+        imgs = self.cache.get(key)
+        if imgs is None:
+            imgs = self.load_imgs(id, plane)
+            imgs = np.rint((imgs - imgs.min()) / (imgs.max() - imgs.min()) * 255)
+            imgs = imgs.astype(np.uint8)
+            self.cache.put(key, imgs)
+        return imgs, 0, 255
+
+    def tensor_path(self, id, plane):
+        if self.tensor_dir is None:
+            key = repr((self.datadir, self.stage,
+                        self.transf[self.stage] if self.transf else None,
+                        self.indp_normalz, self.norm_stats, self.n_slices, self.slice_mode,
+                        self.cache is not None))  # cached volumes are rounded to uint8
+            self.tensor_dir = f'{self.tensor_cache}/{hashlib.sha1(key.encode()).hexdigest()[:16]}'
+            for p in self.planes:
+                os.makedirs(f'{self.tensor_dir}/{p}', exist_ok=True)
+        return f'{self.tensor_dir}/{plane}/{id}.npy'
+
+    def prep_imgs(self, id, plane):
+        if self.tensor_cache is None:
+            imgs = self.norm_imgs(id, plane)
+        else:
+            path = self.tensor_path(id, plane)
+            if os.path.exists(path):
+                with self.timed('load_tensor'):
+                    # copy-on-write map, pages are read as the slices are used
+                    imgs = torch.from_numpy(np.load(path, mmap_mode='c'))
+            else:
+                imgs = self.norm_imgs(id, plane)
+                tmp = f'{path}.{os.getpid()}.tmp.npy'
+                np.save(tmp, imgs.numpy())
+                os.replace(tmp, path)
+
+        # (S, H, W) or (V, S, H, W) -> channel dim after the slices
+        if self.n_chans == 1:
+            imgs = imgs.unsqueeze(-3)
+        else:
+            imgs = imgs.unsqueeze(-3).expand(*imgs.shape[:-2], 3, *imgs.shape[-2:])  # no copy
+
+        return imgs
+
+    def norm_imgs(self, id, plane):
+        if self.indp_normalz:
+            MEAN, SD = self.norm_stats[plane]
+        else:
+            MEAN, SD = self.norm_stats['global']
+        transf = self.transf[self.stage] if self.transf else None
+        with self.timed('load'):
+            imgs, lo, hi = self.load_raw(id, plane)
+
+        # slice selection, the min-max scaling still uses the full volume
+        idx = select_slices(imgs.shape[0], self.n_slices, self.slice_mode, self.random_slices)
+        if idx is not None:
+            imgs = imgs[idx]
+
+        if self.n_views > 1:
+            # every view augments the same slices, so they stack to (V, S, H, W)
+            return torch.stack([self.aug_imgs(imgs, lo, hi, transf, MEAN, SD)
+                                for _ in range(self.n_views)])
+        return self.aug_imgs(imgs, lo, hi, transf, MEAN, SD)
+
+    def aug_imgs(self, imgs, lo, hi, transf, MEAN, SD):
+        # crops/flips are views, so they run on the raw volume and the rescale
+        # + normalization is fused into one float32 buffer of the output size
+        # (with packed storage the memmap is only read during normalization)
+        if is_view_only(transf):
+            if transf:
+                imgs = vol_aug(imgs, transf)
+            with self.timed('normalize'):
+                return torch.from_numpy(normalize_volume(imgs, MEAN, SD, lo, hi))
+
+        # transforms
+        with self.timed('aug'):
+            imgs = (imgs - lo) / (hi - lo) * 255
+            imgs = vol_aug(imgs, transf)
+            imgs = torch.as_tensor(np.ascontiguousarray(imgs), dtype=torch.float32)
+
+        # normalize
+        with self.timed('normalize'):
+            imgs = (imgs - MEAN)/SD
+
+        return imgs
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __getstate__(self):
+        # don't ship an open memmap to the workers
+        state = self.__dict__.copy()
+        state['pack'] = None
+        return state
+
+
+class FeatureDS(MRDS):
+    # serves cached outputs of the frozen backbone prefix instead of images,
+    # see features.build_feature_cache
+    def __init__(self, feature_dir, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.feature_dir = feature_dir
+        self.feature_index = {plane: read_index(feature_path(feature_dir, self.stage, plane))
+                              for plane in self.planes}
+        self.features = None
+
+    def prep_imgs(self, id, plane):
+        if self.features is None:
+            self.features = {p: open_pack(feature_path(self.feature_dir, self.stage, p), index)
+                             for p, index in self.feature_index.items()}
+        feats = read_entry(self.features[plane], self.feature_index[plane], id)
+        return torch.from_numpy(feats.astype(np.float32))
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['features'] = None
+        return state
+
+
+def collate_cases(batch):
+    # packs the variable length slice stacks of several cases into one tensor
+    # per plane + the slice count of every case, so each plane backbone runs once
+    # With n_views every view becomes a segment of its own, case-major, and the
+    # view count is passed on so the model can average the logits per case.
+    imgs, label, id, weight = zip(*batch)
+    if imgs[0][0].dim() == 5:  # (V, S, C, H, W)
+        n_views = imgs[0][0].shape[0]
+        n_slices = [torch.as_tensor([case[i].shape[1] for case in imgs
+                                     for _ in range(n_views)])
+                    for i in range(len(imgs[0]))]
+        imgs = [torch.cat([case[i].flatten(0, 1) for case in imgs])
+                for i in range(len(imgs[0]))]
+        return (imgs, n_slices, n_views), torch.stack(label), list(id), torch.stack(weight)
+    n_slices = [torch.as_tensor([case[i].shape[0] for case in imgs])
+                for i in range(len(imgs[0]))]
+    imgs = [torch.cat([case[i] for case in imgs])
+            for i in range(len(imgs[0]))]
+    return (imgs, n_slices), torch.stack(label), list(id), torch.stack(weight)
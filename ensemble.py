@@ -0,0 +1,109 @@
+# %%
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.metrics import check_scoring, roc_auc_score
+from sklearn.model_selection import StratifiedKFold
+
+
+class VotingCLF(BaseEstimator, ClassifierMixin):
+    # Votes over the per-plane probabilities of get_preds. X is a DataFrame with
+    # one column per plane (or an array with the planes as columns), planes=None
+    # uses every column. weights gives each plane a say, equal by default.
+    # hard: weighted share of planes with p > threshold, positive above 1/2
+    # soft: weighted mean of p, positive above threshold
+
+    def __init__(self, method='hard', threshold=0.5, planes=None, weights=None):
+        self.method = method
+        self.threshold = threshold
+        self.planes = planes
+        self.weights = weights
+
+    def _probs(self, X):
+        if hasattr(X, 'columns'):
+            X = X[self.planes] if self.planes is not None else X
+        return np.asarray(X, dtype=np.float64)
+
+    def _weights(self, n_planes):
+        w = np.ones(n_planes) if self.weights is None else np.asarray(self.weights, float)
+        return w / w.sum()
+
+    def fit(self, X, y):
+        self.classes_ = np.unique(y)
+        self.n_features_in_ = self._probs(X).shape[1]
+        return self
+
+    def decision_function(self, X):
+        P = self._probs(X)
+        if self.method == 'hard':
+            P = P > self.threshold
+        return P @ self._weights(P.shape[1])
+
+    def predict_proba(self, X):
+        score = self.decision_function(X)
+        return np.stack([1 - score, score], 1)
+
+    def predict(self, X):
+        cut = 0.5 if self.method == 'hard' else self.threshold
+        return (self.decision_function(X) > cut).astype(np.int64)
+
+    def sweep(self, X, y, thresholds, weights=None):
+        # accuracy of every (weights, threshold) pair, (n_weights, n_thresholds),
+        # in one pass over the prediction matrix. The best pair is kept in
+        # best_params_, use set_params(**clf.best_params_) to vote with it
+        P = self._probs(X)
+        y = np.asarray(y).astype(bool)
+        thresholds = np.asarray(thresholds, float)
+        W = np.ones((1, P.shape[1])) if weights is None else np.atleast_2d(weights).astype(float)
+        W = W / W.sum(1, keepdims=True)
+        if self.method == 'hard':
+            votes = P[:, :, None] > thresholds  # (n, planes, thresholds)
+            pos = np.einsum('npt,wp->nwt', votes, W) > 0.5
+        else:
+            pos = (P @ W.T)[:, :, None] > thresholds  # (n, weights, thresholds)
+        scores = (pos == y[:, None, None]).mean(0)
+
+        i, j = np.unravel_index(scores.argmax(), scores.shape)
+        self.best_weights_ = None if weights is None else W[i]
+        self.best_threshold_ = thresholds[j]
+        self.best_params_ = {'weights': self.best_weights_, 'threshold': self.best_threshold_}
+        return scores
+
+
+def _fit_score(clf, X, y, train, test, scoring):
+    clf.fit(_take(X, train), _take(y, train))
+    return scoring(clf, _take(X, test), _take(y, test))
+
+
+def _take(X, idx):
+    return X.iloc[idx] if hasattr(X, 'iloc') else X[idx]
+
+
+def _val_auc(clf, X, y, X_val, y_val):
+    clf.fit(X, y)
+    if hasattr(clf, 'predict_proba'):
+        preds = clf.predict_proba(X_val)[:, 1]
+    else:
+        preds = clf.predict(X_val)
+    return roc_auc_score(y_val, preds)
+
+
+def compare_clfs(clfs, X, y, X_val, y_val, cv=5, scoring=None, n_jobs=-1):
+    # every classifier x CV fold and every validation fit runs as its own job;
+    # all classifiers see the same folds. scoring=None is the clf's own score
+    splits = list(StratifiedKFold(cv).split(X, y))
+    jobs = []
+    for clf in clfs.values():
+        scorer = check_scoring(clf, scoring)
+        jobs += [delayed(_fit_score)(clone(clf), X, y, train, test, scorer)
+                 for train, test in splits]
+        jobs.append(delayed(_val_auc)(clone(clf), X, y, X_val, y_val))
+    out = Parallel(n_jobs=n_jobs)(jobs)
+
+    results = {}
+    for i, name in enumerate(clfs):
+        res = out[i * (cv + 1):(i + 1) * (cv + 1)]
+        results[name] = {'cv_score': np.mean(res[:-1]), 'val_auc': res[-1]}
+        print(f'{name}: CV_SCORE: {results[name]["cv_score"]:.4f} '
+              f'VAL_AUC: {results[name]["val_auc"]:.4f}')
+    return results
@@ -0,0 +1,104 @@
+# %%
+import argparse
+import json
+from typing import List
+
+import torch
+import torch.nn as nn
+
+from model import MRKnee
+from stats import NORM_STATS, load_stats
+
+# Exports the per-plane checkpoints get_preds uses into one TorchScript file
+# that score.py runs with only torch + numpy installed. The backbones are
+# traced, the slice pooling is scripted so cases of any slice count can be
+# batched, and the preprocessing settings ship in the file as meta.json.
+
+
+class PlaneModel(nn.Module):
+    def __init__(self, backbone, clf, final_pool='max'):
+        super().__init__()
+        self.backbone = backbone
+        self.clf = clf
+        self.pool_max = final_pool == 'max'
+
+    def forward(self, x: torch.Tensor, n_slices: List[int]) -> torch.Tensor:
+        feats = self.backbone(x)
+        pooled = []
+        for seg in torch.split(feats, n_slices):
+            if self.pool_max:
+                pooled.append(torch.max(seg, 0)[0])
+            else:
+                pooled.append(torch.mean(seg, 0))
+        return self.clf(torch.stack(pooled))
+
+
+class PlaneEnsemble(nn.Module):
+    # imgs/n_slices per plane as from collate_cases -> (B, n_planes) probabilities
+    def __init__(self, plane_models):
+        super().__init__()
+        self.plane_models = nn.ModuleList(plane_models)
+
+    def forward(self, imgs: List[torch.Tensor], n_slices: List[List[int]]) -> torch.Tensor:
+        logits = []
+        for i, plane_model in enumerate(self.plane_models):
+            logits.append(plane_model(imgs[i], n_slices[i]))
+        return torch.sigmoid(torch.cat(logits, 1))
+
+
+def export_torchscript(out_path,
+                       diagnosis,
+                       planes=['axial', 'sagittal', 'coronal'],
+                       ckpt_dir='models/',
+                       backbones=['efficientnet_b0', 'efficientnet_b0', 'efficientnet_b0'],
+                       img_size=256,
+                       crop=None,
+                       n_chans=1,
+                       norm_stats=None,
+                       quantize=False):
+    plane_models = []
+    for plane, backbone in zip(planes, backbones):
+        model = MRKnee.from_checkpoint(f'{ckpt_dir}{diagnosis}_{plane}.ckpt',
+                                       planes=[plane], backbone=backbone, n_chans=n_chans)
+        model.freeze()
+        clf = model.clf
+        if quantize:
+            # dynamic int8 of the Linear head. quantize_dynamic only swaps the
+            # children of the module it gets, so the head goes in a container.
+            # The backbone stays float, the gain is small
+            clf = torch.quantization.quantize_dynamic(
+                nn.Sequential(clf), {nn.Linear}, dtype=torch.qint8)[0]
+            if not isinstance(clf, torch.nn.quantized.dynamic.Linear):
+                raise RuntimeError(f'head was not quantized, got {type(clf).__name__}')
+        example = torch.randn(2, n_chans, crop or img_size, crop or img_size)
+        backbone = torch.jit.trace(model.backbones[0], example)
+        plane_models.append(PlaneModel(backbone, clf, model.final_pool))
+
+    scripted = torch.jit.script(PlaneEnsemble(plane_models).eval())
+    mean, sd = (load_stats(norm_stats) if norm_stats else NORM_STATS)['global']
+    meta = {'diagnosis': diagnosis, 'planes': planes, 'crop': crop,
+            'n_chans': n_chans, 'mean': mean, 'sd': sd}
+    torch.jit.save(scripted, out_path, _extra_files={'meta.json': json.dumps(meta)})
+    return scripted
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export per-plane MRKnee checkpoints to one TorchScript file.')
+    parser.add_argument('diagnosis')
+    parser.add_argument('--out', default=None, help='defaults to {diagnosis}.pt')
+    parser.add_argument('--ckpt-dir', default='models/')
+    parser.add_argument('--planes', nargs='+', default=['axial', 'sagittal', 'coronal'])
+    parser.add_argument('--backbones', nargs='+',
+                        default=['efficientnet_b0', 'efficientnet_b0', 'efficientnet_b0'])
+    parser.add_argument('--img-size', type=int, default=256)
+    parser.add_argument('--crop', type=int, default=None)
+    parser.add_argument('--n-chans', type=int, default=1)
+    parser.add_argument('--norm-stats', default=None)
+    parser.add_argument('--quantize', action='store_true')
+    args = parser.parse_args()
+
+    export_torchscript(args.out or f'{args.diagnosis}.pt', args.diagnosis, args.planes,
+                       args.ckpt_dir, args.backbones, args.img_size, args.crop,
+                       args.n_chans, args.norm_stats, args.quantize)
@@ -0,0 +1,89 @@
+# %%
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from pack import write_pack
+
+# Feature cache for frozen backbones. The outputs of the frozen prefix of every
+# plane backbone are computed once per case and packed to
+# {cache_dir}/{hash}/{stage}-{plane}.pack, where the hash covers the prefix
+# weights and the preprocessing. Usage:
+#
+#   model = MRKnee(freeze_from=0, unfreeze_epoch=-1, ...)
+#   feature_dir, k = build_feature_cache(model, MRKneeDataModule(**data_args))
+#   dm = MRKneeDataModule(**data_args, feature_dir=feature_dir)
+#   model.feature_prefix = k
+#   trainer.fit(model, dm)
+
+
+def frozen_prefix(module):
+    # number of leading layers that are frozen and deterministic, so their
+    # output can be cached: stops at the first layer with trainable parameters
+    # or with dropout, which has to keep running live in train mode
+    k = 0
+    for layer in module:
+        if any(p.requires_grad for p in layer.parameters()) or _stochastic(layer):
+            break
+        k += 1
+    return k
+
+
+def _stochastic(layer):
+    return any((isinstance(m, nn.modules.dropout._DropoutNd) and m.p > 0)
+               or (getattr(m, 'drop_prob', 0) or 0) > 0  # timm DropPath
+               for m in layer.modules())
+
+
+def feature_path(feature_dir, stage, plane):
+    return f'{feature_dir}/{stage}-{plane}.pack'
+
+
+def cache_key(model, k, datasets):
+    h = hashlib.sha1()
+    for module in model.backbones:
+        for name, t in module[:k].state_dict().items():
+            h.update(name.encode())
+            h.update(t.detach().cpu().numpy().tobytes())
+    for ds in datasets:
+        h.update(repr((ds.stage, ds.planes, ds.n_chans, ds.indp_normalz, ds.norm_stats,
+                       ds.n_slices, ds.slice_mode,
+                       ds.transf[ds.stage] if ds.transf else None)).encode())
+    return h.hexdigest()[:16]
+
+
+@torch.no_grad()
+def build_feature_cache(model, dm, cache_dir='cache/features', device='cpu'):
+    k = min(frozen_prefix(module) for module in model.backbones)
+    if k == 0:
+        raise ValueError('backbones have no frozen prefix to cache, use freeze_from=0')
+
+    datasets = [dm.train_ds, dm.val_ds]
+    for ds in datasets:
+        if not ds.is_deterministic():
+            raise ValueError(f'{ds.stage} pipeline is random, features cannot be cached')
+
+    feature_dir = f'{cache_dir}/{cache_key(model, k, datasets)}'
+    os.makedirs(feature_dir, exist_ok=True)
+
+    for ds in datasets:
+        for module, plane in zip(model.backbones, ds.planes):
+            path = feature_path(feature_dir, ds.stage, plane)
+            if os.path.exists(path + '.json'):
+                continue
+            prefix = module[:k].to(device)
+            was_training = prefix.training
+            prefix.eval()
+
+            def arrays():
+                for id, _ in ds.cases:
+                    imgs = ds.prep_imgs(id, plane).to(device)
+                    yield id, prefix(imgs).cpu().numpy()
+
+            write_pack(path, arrays(), dtype=np.float16)
+            prefix.train(was_training)
+
+    return feature_dir, k
@@ -0,0 +1,109 @@
+# %%
+import hashlib
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from dataset import MRDS, collate_cases
+from model import MRKnee, _plane_executor, _run_in_thread
+
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)  # torch < 1.9
+
+
+class Predictor():
+    # holds one single-plane MRKnee per plane and scores all planes of a batch
+    # of cases in one pass over the data
+    def __init__(self,
+                 diagnosis,
+                 planes=['axial', 'sagittal', 'coronal'],
+                 ckpt_dir='models/',
+                 backbones=['efficientnet_b0', 'efficientnet_b0', 'efficientnet_b0'],
+                 device='cpu',
+                 plane_parallel=False):
+        self.diagnosis = diagnosis
+        self.plane_parallel = plane_parallel
+        self.planes = planes
+        self.device = torch.device(device)
+        self.models = []
+        for plane, backbone in zip(planes, backbones):
+            model = MRKnee.from_checkpoint(
+                f'{ckpt_dir}{diagnosis}_{plane}.ckpt', planes=[plane], backbone=backbone)
+            model.freeze()
+            model.to(self.device)
+            self.models.append(model)
+
+    def predict_batch(self, imgs, n_slices, n_views=1):
+        # imgs/n_slices per plane as produced by collate_cases -> (B, n_planes)
+        with inference_mode():
+            imgs = [([x.to(self.device, non_blocking=True)], [n], n_views)
+                    for x, n in zip(imgs, n_slices)]
+            if self.plane_parallel and len(self.models) > 1:
+                inference = getattr(torch, 'is_inference_mode_enabled', lambda: False)()
+                futures = [_plane_executor(len(self.models)).submit(
+                    _run_in_thread, model, False, inference, x)
+                    for model, x in zip(self.models, imgs)]
+                logits = [f.result() for f in futures]
+            else:
+                logits = [model(x) for model, x in zip(self.models, imgs)]
+            return torch.sigmoid(torch.cat(logits, 1)).cpu().numpy()
+
+    def predict_stage(self, datadir, stage='train', batch_size=8, num_workers=0,
+                      tta=None, n_views=8, **ds_kwargs):
+        # tta: albumentations transforms (list or A.Compose), each case is scored on n_views
+        # augmented views that go through the backbones as one batch
+        ds_kwargs.setdefault('random_slices', False)  # scoring is deterministic
+        if tta:
+            ds_kwargs.update(transf={stage: tta}, n_views=n_views)
+        ds = MRDS(datadir, stage, self.diagnosis, planes=self.planes,
+                  indp_normalz=False, **ds_kwargs)
+        dl = DataLoader(ds, batch_size=batch_size, shuffle=False,
+                        collate_fn=collate_cases, num_workers=num_workers,
+                        pin_memory=self.device.type == 'cuda')
+
+        preds = np.empty((len(ds), len(self.planes)), dtype=np.float32)
+        i = 0
+        for imgs, label, sample_id, weight in dl:
+            out = self.predict_batch(*imgs)
+            preds[i:i + len(out)] = out
+            i += len(out)
+
+        import pandas as pd
+        preds = pd.DataFrame(preds, columns=self.planes)
+        preds['lbls'] = [lbl for id, lbl in ds.cases]
+        preds['ids'] = [id for id, lbl in ds.cases]
+        return preds
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PredStore():
+    # one npz per plane prediction column, keyed by everything that changes it
+    def __init__(self, cache_dir='cache/preds'):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, ckpt, backbone, plane, stage, csv_path, extra=''):
+        parts = [file_hash(ckpt), backbone, plane, stage, file_hash(csv_path)]
+        if extra:  # keeps the keys of the plain predictions unchanged
+            parts.append(extra)
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:16]
+
+    def load(self, key):
+        path = f'{self.cache_dir}/{key}.npz'
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            return f['preds']
+
+    def save(self, key, ids, preds):
+        path = f'{self.cache_dir}/{key}.npz'
+        np.savez(path + '.tmp.npz', ids=np.asarray(ids), preds=np.asarray(preds))
+        os.replace(path + '.tmp.npz', path)
@@ -0,0 +1,264 @@
+# %%
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib.pyplot as plt
+import pandas as pd
+from IPython.display import display
+from ipywidgets import interact, Dropdown, IntSlider, VBox
+import numpy as np
+
+
+def show_batch(img_tens):
+    inp = img_tens.squeeze(1).numpy()
+    fig = plt.figure(figsize=(20, 20))
+    n_imgs = inp.shape[0]
+    n_rows = np.ceil(n_imgs / 6)
+    for i in range(n_imgs):
+        fig.add_subplot(n_rows, 6, i+1)
+        plt.imshow(inp[i, :, :], cmap='gray')
+        plt.axis('off')
+        plt.subplots_adjust(wspace=0, hspace=0)
+    plt.show()
+
+
+def load_one_stack(case, data_path=None, plane='coronal'):
+    fpath = '{}/{}/{}.npy'.format(data_path, plane, case)
+    return np.load(fpath)
+
+
+def load_stacks(case, data_path=None):
+    x = {}
+    planes = ['coronal', 'sagittal', 'axial']
+    for i, plane in enumerate(planes):
+        x[plane] = load_one_stack(case, plane=plane, data_path=data_path)
+    return x
+
+
+def npy_shape(fpath):
+    # shape from the .npy header, without reading the array
+    with open(fpath, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            return np.lib.format.read_array_header_1_0(f)[0]
+        return np.lib.format.read_array_header_2_0(f)[0]
+
+
+class CaseStore():
+    # Lazy stand in for the dict of load_cases: volumes are read when a case is
+    # looked up and only the max_cases most recently viewed cases are kept.
+    # With mmap the planes are memory mapped, so only the shown slices are read.
+    def __init__(self, case_list, data_path, max_cases=8, mmap=False,
+                 planes=['coronal', 'sagittal', 'axial']):
+        self.case_list = list(case_list)
+        self.case_set = set(self.case_list)
+        self.data_path = data_path
+        self.max_cases = max_cases
+        self.mmap_mode = 'r' if mmap else None
+        self.planes = planes
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()  # KneePlot prefetches from a thread
+
+    def fpath(self, case, plane):
+        return '{}/{}/{}.npy'.format(self.data_path, plane, case)
+
+    def slice_count(self, case, plane):
+        return npy_shape(self.fpath(case, plane))[0]
+
+    def __getitem__(self, case):
+        with self.lock:
+            if case in self.lru:
+                self.lru.move_to_end(case)
+                return self.lru[case]
+        if case not in self.case_set:
+            raise KeyError(case)
+        x = {plane: np.load(self.fpath(case, plane), mmap_mode=self.mmap_mode)
+             for plane in self.planes}
+        with self.lock:
+            self.lru[case] = x
+            if len(self.lru) > self.max_cases:
+                self.lru.popitem(last=False)
+        return x
+
+    def keys(self):
+        return list(self.case_list)
+
+    def __iter__(self):
+        return iter(self.case_list)
+
+    def __len__(self):
+        return len(self.case_list)
+
+    def __contains__(self, case):
+        return case in self.case_set
+
+
+class SliceNums(dict):
+    # case -> {plane: n_slices}, filled in on first access. A CaseStore answers
+    # from the .npy headers, so browsing doesn't load the volumes
+    def __init__(self, cases):
+        super().__init__()
+        self.cases = cases
+
+    def __missing__(self, case):
+        if hasattr(self.cases, 'slice_count'):
+            n = {plane: self.cases.slice_count(case, plane)
+                 for plane in ['coronal', 'sagittal', 'axial']}
+        else:
+            n = {plane: self.cases[case][plane].shape[0]
+                 for plane in ['coronal', 'sagittal', 'axial']}
+        self[case] = n
+        return n
+
+
+def load_cases(train=True, lazy=False, max_cases=8, mmap=False):
+    if train:
+        case_list = pd.read_csv('data/train-acl.csv', names=['case', 'label'], header=None,
+                                dtype={'case': str, 'label': np.int64})['case'].tolist()
+        data_path = 'data/train'
+    else:
+        case_list = pd.read_csv('data/valid-acl.csv', names=['case', 'label'], header=None,
+                                dtype={'case': str, 'label': np.int64})['case'].tolist()
+        data_path = 'data/valid'
+    if lazy:
+        return CaseStore(case_list, data_path, max_cases, mmap)
+    cases = {}
+
+    for case in case_list:
+        x = load_stacks(case, data_path)
+        cases[case] = x
+    return cases
+
+
+class KneePlot():
+    # cases: the dict of load_cases or a CaseStore
+    def __init__(self, cases, figsize=(15, 5)):
+        self.cases = cases
+
+        self.planes = {case: ['coronal', 'sagittal', 'axial'] for case in self.cases}
+
+        self.slice_nums = SliceNums(cases)
+
+        self.figsize = figsize
+        self.prefetch_pool = None  # one thread for every draw_live call
+
+    def _plot_slices(self, case, im_slice_coronal, im_slice_sagittal, im_slice_axial):
+        fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=self.figsize)
+
+        ax1.imshow(self.cases[case]['coronal'][im_slice_coronal, :, :], 'gray')
+        ax1.set_title(f'MRI slice {im_slice_coronal} on coronal plane')
+
+        ax2.imshow(self.cases[case]['sagittal'][im_slice_sagittal, :, :], 'gray')
+        ax2.set_title(f'MRI slice {im_slice_sagittal} on sagittal plane')
+
+        ax3.imshow(self.cases[case]['axial'][im_slice_axial, :, :], 'gray')
+        ax3.set_title(f'MRI slice {im_slice_axial} on axial plane')
+        plt.subplots_adjust(wspace=0, hspace=0)
+        plt.show()
+
+    def draw(self):
+        case_widget = Dropdown(options=list(self.cases.keys()),
+                               description='Case'
+
+                               )
+        case_init = list(self.cases.keys())[0]
+
+        slice_init_coronal = self.slice_nums[case_init]['coronal'] - 1
+        slices_widget_coronal = IntSlider(min=0,
+                                          max=slice_init_coronal,
+                                          value=slice_init_coronal // 2,
+                                          description='Coronal')
+
+        slice_init_sagittal = self.slice_nums[case_init]['sagittal'] - 1
+        slices_widget_sagittal = IntSlider(min=0,
+                                           max=slice_init_sagittal,
+                                           value=slice_init_sagittal // 2,
+                                           description='Sagittal'
+                                           )
+
+        slice_init_axial = self.slice_nums[case_init]['axial'] - 1
+        slices_widget_axial = IntSlider(min=0,
+                                        max=slice_init_axial,
+                                        value=slice_init_axial // 2,
+                                        description='Axial'
+                                        )
+
+        def update_slices_widget(*args):
+            slices_widget_coronal.max = self.slice_nums[case_widget.value]['coronal'] - 1
+            slices_widget_coronal.value = slices_widget_coronal.max // 2
+
+            slices_widget_sagittal.max = self.slice_nums[case_widget.value]['sagittal'] - 1
+            slices_widget_sagittal.value = slices_widget_sagittal.max // 2
+
+            slices_widget_axial.max = self.slice_nums[case_widget.value]['axial'] - 1
+            slices_widget_axial.value = slices_widget_axial.max // 2
+
+        case_widget.observe(update_slices_widget, 'value')
+        interact(self._plot_slices,
+                 case=case_widget,
+                 im_slice_coronal=slices_widget_coronal,
+                 im_slice_sagittal=slices_widget_sagittal,
+                 im_slice_axial=slices_widget_axial
+                 )
+
+    def draw_live(self, prefetch=2):
+        # Builds the figure once and on a slider move only swaps the image of
+        # that plane. Meanwhile a thread reads the next slices of the plane and
+        # the neighbouring cases. Needs an interactive backend (%matplotlib widget)
+        planes = ['coronal', 'sagittal', 'axial']
+        case_list = list(self.cases.keys())
+        if self.prefetch_pool is None:
+            self.prefetch_pool = ThreadPoolExecutor(1)
+        pool = self.prefetch_pool
+        case_widget = Dropdown(options=case_list, description='Case')
+        sliders = {plane: IntSlider(min=0, description=plane.capitalize())
+                   for plane in planes}
+
+        fig, axes = plt.subplots(1, 3, figsize=self.figsize)
+        plt.subplots_adjust(wspace=0, hspace=0)
+        artists = {}
+
+        def warm(case, plane, idx):
+            # reading the slices pulls memory mapped pages into the page cache
+            vol = self.cases[case][plane]
+            np.asarray(vol[max(idx - prefetch, 0):idx + prefetch + 1]).sum()
+            i = case_list.index(case)
+            for neighbour in case_list[i + 1:i + 2] + case_list[max(i - 1, 0):i]:
+                self.cases[neighbour]
+
+        def show(plane, idx):
+            case = case_widget.value
+            img = self.cases[case][plane][idx]
+            ax = axes[planes.index(plane)]
+            if plane in artists:
+                artists[plane].set_data(img)
+                artists[plane].set_clim(img.min(), img.max())
+            else:
+                artists[plane] = ax.imshow(img, 'gray')
+            ax.set_title(f'MRI slice {idx} on {plane} plane')
+            if prefetch:
+                pool.submit(warm, case, plane, idx)
+
+        def on_slice(change):
+            plane = planes[[sliders[p] for p in planes].index(change['owner'])]
+            show(plane, change['new'])
+            fig.canvas.draw_idle()
+
+        def on_case(*args):
+            for plane in planes:
+                slider = sliders[plane]
+                slider.unobserve(on_slice, 'value')
+                slider.max = self.slice_nums[case_widget.value][plane] - 1
+                slider.value = slider.max // 2
+                slider.observe(on_slice, 'value')
+                show(plane, slider.value)
+            fig.canvas.draw_idle()
+
+        case_widget.observe(on_case, 'value')
+        on_case()
+        display(VBox([case_widget] + list(sliders.values())))
+        plt.show()
+
+    def resize(self, figsize):
+        self.figsize = figsize
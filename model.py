@@ -1,17 +1,80 @@
 
 # %%
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache, partial
 import pytorch_lightning as pl
 from pytorch_lightning.metrics.functional.classification import auroc
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.modules.container import ModuleList
+from torch.utils.checkpoint import checkpoint
 
 import timm
 
 # %%
 
 
+@lru_cache(maxsize=None)
+def _plane_executor(n_planes):
+    return ThreadPoolExecutor(max_workers=n_planes, thread_name_prefix='plane')
+
+
+@lru_cache(maxsize=None)
+def _plane_streams(device, n_planes):
+    return [torch.cuda.Stream(device=device) for _ in range(n_planes)]
+
+
+def _run_in_thread(fn, grad_enabled, inference, *args):
+    # grad and inference mode are thread local, carry them over from the caller
+    mode = torch.inference_mode() if inference else torch.set_grad_enabled(grad_enabled)
+    with mode:
+        return fn(*args)
+
+
+def _checkpointed(model, x):
+    # checkpoint runs the forward without grad and again with grad during
+    # backward; the recompute must not update the BatchNorm running stats twice
+    if not torch.is_grad_enabled():
+        return model(x)
+    bns = [m for m in model.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training
+           and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0  # running = 1 * running + 0 * batch
+    try:
+        return model(x)
+    finally:
+        for m, (momentum, n) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(n)
+
+
+def _all_gather(x):
+    # x of every rank concatenated along dim 0, shards may differ in length
+    if not (dist.is_available() and dist.is_initialized()):
+        return x
+    n = torch.tensor([x.shape[0]], device=x.device)
+    sizes = [torch.zeros_like(n) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, n)
+    padded = x.new_zeros((int(max(sizes)), *x.shape[1:]))
+    padded[:x.shape[0]] = x
+    out = [torch.zeros_like(padded) for _ in sizes]
+    dist.all_gather(out, padded)
+    return torch.cat([o[:int(size)] for o, size in zip(out, sizes)])
+
+
+def _first_of_each(pos):
+    # indices that keep one row per distinct value of pos
+    uniq, inverse = torch.unique(pos, return_inverse=True)
+    keep = torch.empty(len(uniq), dtype=torch.int64, device=pos.device)
+    keep[inverse] = torch.arange(len(pos), device=pos.device)
+    return keep
+
+
 class MRKnee(pl.LightningModule):
     def __init__(self,
                  backbone='efficientnet_b0',
@@ -24,7 +87,12 @@ class MRKnee(pl.LightningModule):
                  planes=['axial', 'sagittal', 'coronal'],
                  log_auc=True,
                  log_ind_loss=False,
-                 final_pool='max'):
+                 final_pool='max',
+                 feature_prefix=0,  # >0 when batches hold cached prefix features
+                 chunk_size=None,  # run the slices in micro-batches of this size
+                 grad_ckpt=False,  # activation checkpointing of the chunks
+                 diagnoses=None,  # one logit per diagnosis when training several
+                 plane_parallel=False):  # run the plane backbones concurrently
         super().__init__()
         self.learning_rate = learning_rate
         self.freeze_from = freeze_from
@@ -32,39 +100,145 @@ class MRKnee(pl.LightningModule):
         self.log_auc = log_auc
         self.log_ind_loss = log_ind_loss
         self.n_planes = len(planes)
+        self.planes = planes
+        self.diagnoses = diagnoses
+        self.plane_parallel = plane_parallel
         self.backbones = [timm.create_model(backbone, pretrained=pretrained, num_classes=0,
                                             in_chans=n_chans, drop_rate=drop_rate, ) for i in range(self.n_planes)]
         self.num_features = self.backbones[0].num_features
         self.final_pool = final_pool
+        self.feature_prefix = feature_prefix
+        self.chunk_size = chunk_size
+        self.grad_ckpt = grad_ckpt
 
         # freeze backbones
         self.backbones = ModuleList([self._freeze(module.as_sequential(), freeze_from)
                                      for module in self.backbones])
-        self.clf = nn.Linear(self.num_features*self.n_planes, 1)
-        # logging
-        self.t_sample_loss = {}
-        self.v_sample_loss = {}
+        self.clf = nn.Linear(self.num_features*self.n_planes,
+                             len(diagnoses) if diagnoses else 1)
+        # logging, per case losses go to the datamodule's LossStores
         self.best_val_loss = 20
+        self.timer = None  # timing.StageTimer, set by callbacks.StageTimingCallback
 
-    def run_model(self, model, series):
-        x = torch.squeeze(series, dim=0)
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path, **kwargs):
+        # the checkpoint overwrites every weight, don't build pretrained ones first
+        return cls.load_from_checkpoint(checkpoint_path, pretrained=False, **kwargs)
+
+    def run_model(self, model, series, n_slices=None):
+        if n_slices is None:  # single case, (1, S, C, H, W)
+            x = torch.squeeze(series, dim=0)
+            n_slices = [x.shape[0]]
+        else:  # packed cases, (sum S, C, H, W)
+            x = series
+            n_slices = n_slices.tolist()
+        if self.feature_prefix:
+            model = model[self.feature_prefix:]
+        if self.chunk_size and x.shape[0] > self.chunk_size:
+            return self._run_chunked(model, x, n_slices)
         x = model(x)
-       # x = torch.max(x, 0, keepdim=True)[0]  # Hvad gør det?
+        return self._pool(x, n_slices)
+
+    def _run_chunk(self, model, x):
+        if self.grad_ckpt and self.training and torch.is_grad_enabled():
+            # the input needs grad for checkpoint to backprop into the params
+            return checkpoint(partial(_checkpointed, model), x.detach().requires_grad_())
+        return model(x)
+
+    def _run_chunked(self, model, x, n_slices):
+        # folds every chunk into a running max/sum per case, so only one chunk
+        # of activations is alive (during training only with grad_ckpt)
+        if self.final_pool not in ('max', 'avg'):
+            return torch.cat([self._run_chunk(model, chunk)
+                              for chunk in torch.split(x, self.chunk_size)])
+        ends = torch.as_tensor(n_slices).cumsum(0).tolist()
+        starts = [0] + ends[:-1]
+        pooled = [None] * len(n_slices)
+        for c_start in range(0, x.shape[0], self.chunk_size):
+            feats = self._run_chunk(model, x[c_start:c_start + self.chunk_size])
+            c_end = c_start + feats.shape[0]
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                lo, hi = max(start, c_start), min(end, c_end)
+                if lo >= hi:
+                    continue
+                seg = feats[lo - c_start:hi - c_start]
+                if self.final_pool == 'max':
+                    part = seg.max(0)[0]
+                    pooled[i] = part if pooled[i] is None else torch.max(pooled[i], part)
+                else:
+                    part = seg.sum(0)
+                    pooled[i] = part if pooled[i] is None else pooled[i] + part
+        pooled = torch.stack(pooled)
+        if self.final_pool == 'avg':
+            pooled = pooled / torch.as_tensor(n_slices, dtype=pooled.dtype,
+                                              device=pooled.device).unsqueeze(1)
+        return pooled
+
+    def _pool(self, x, n_slices):
+        # segment-wise pooling over the slices of each case -> (B, num_features)
         if self.final_pool == 'max':
-            x = F.adaptive_max_pool2d(x.unsqueeze(0), (1, self.num_features))
-            x = x.squeeze(0)
+            return torch.stack([seg.max(0)[0] for seg in torch.split(x, n_slices)])
         elif self.final_pool == 'avg':
-            x = F.adaptive_avg_pool2d(x.unsqueeze(0), (1, self.num_features))
-            x = x.squeeze(0)
+            return torch.stack([seg.mean(0) for seg in torch.split(x, n_slices)])
         return x
 
-    def forward(self, x):
-        x = [self.run_model(model, series)
-             for model, series in zip(self.backbones, x)]
+    def forward(self, x, n_views=1):
+        if isinstance(x, tuple):  # from collate_cases
+            if len(x) == 3:  # several augmented views per case
+                x, n_slices, n_views = x
+            else:
+                x, n_slices = x
+        else:
+            n_slices = [None] * len(x)
+        if self.plane_parallel and self.n_planes > 1:
+            with self._timed('backbones', x[0]):
+                x = self._run_planes_parallel(x, n_slices)
+        else:
+            out = []
+            for model, series, n, plane in zip(self.backbones, x, n_slices, self.planes):
+                with self._timed(f'backbone_{plane}', series):
+                    out.append(self.run_model(model, series, n))
+            x = out
         x = torch.cat(x, 1)
         x = self.clf(x)
+        if n_views > 1:  # (B * V, T) case-major -> mean logit over the views
+            x = x.view(-1, n_views, x.shape[1]).mean(1)
         return x
 
+    def _timed(self, stage, tensor):
+        if self.timer is None:
+            return nullcontext()
+        return self.timer(f'{"train" if self.training else "valid"}/{stage}', tensor.device)
+
+    def transfer_batch_to_device(self, batch, device, *args, **kwargs):
+        if self.timer is None:
+            return super().transfer_batch_to_device(batch, device, *args, **kwargs)
+        with self.timer(f'{"train" if self.training else "valid"}/h2d', torch.device(device)):
+            return super().transfer_batch_to_device(batch, device, *args, **kwargs)
+
+    def _run_planes_parallel(self, x, n_slices):
+        args = list(zip(self.backbones, x, n_slices))
+        if x[0].is_cuda:
+            # one stream per plane, kernels of the planes overlap on the device
+            current = torch.cuda.current_stream(x[0].device)
+            streams = _plane_streams(x[0].device, len(args))
+            out = []
+            for stream, (model, series, n) in zip(streams, args):
+                stream.wait_stream(current)
+                with torch.cuda.stream(stream):
+                    out.append(self.run_model(model, series, n))
+                series.record_stream(stream)
+            for stream in streams:
+                current.wait_stream(stream)
+            return out
+
+        # on cpu the ops release the GIL, so threads give inter-op parallelism
+        inference = getattr(torch, 'is_inference_mode_enabled', lambda: False)()
+        futures = [_plane_executor(len(args)).submit(
+            _run_in_thread, self.run_model, torch.is_grad_enabled(), inference, *a)
+            for a in args]
+        return [f.result() for f in futures]
+
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(
             self.parameters(), lr=self.learning_rate, weight_decay=0.01)
@@ -84,54 +258,95 @@ class MRKnee(pl.LightningModule):
     def training_step(self, batch, batchidx):
         imgs, label, sample_id, weight = batch
         logit = self(imgs)
-        loss = F.binary_cross_entropy_with_logits(
-            logit, label, pos_weight=weight)
+        sample_loss = self._sample_loss(logit, label, weight)
+        loss = sample_loss.mean()
 
         # logging
-        self.log('train_loss', loss, prog_bar=True, on_epoch=True, on_step=False)
-        if self.log_ind_loss:
-            self.t_sample_loss[sample_id] = (loss.detach(), label)
+        self.log('train_loss', loss, prog_bar=True, on_epoch=True, on_step=False,
+                 sync_dist=True)
+        store = self._loss_store('loss_store')
+        if store is not None:  # the hard example sampler needs it every step
+            store.update(sample_id, sample_loss)
         return loss
 
+    def _sample_loss(self, logit, label, weight):
+        # (B,) loss per case, its mean is the usual batch loss
+        return F.binary_cross_entropy_with_logits(
+            logit, label, pos_weight=weight, reduction='none').mean(1)
+
+    def _loss_store(self, name):
+        dm = getattr(self.trainer, 'datamodule', None) if self.trainer else None
+        return getattr(dm, name, None)
+
+    def on_train_epoch_end(self, *args):
+        store = self._loss_store('loss_store')
+        if store is not None:  # the next epoch samples on the losses of all ranks
+            store.sync()
+
     def on_train_epoch_start(self):
         if self.current_epoch == self.unfreeze_epoch:
+            if self.freeze_from % len(self.backbones[0]) < self.feature_prefix:
+                raise RuntimeError('unfreezing layers that are served from the feature cache')
             self.backbones = ModuleList([self._unfreeze(module, self.freeze_from)
                                          for module in self.backbones])
 
     def validation_step(self, batch, batchidx):
         imgs, label, sample_id, weight = batch
         logit = self(imgs)
-        loss = F.binary_cross_entropy_with_logits(
-            logit, label, pos_weight=weight)
-
-        # logging
+        sample_loss = self._sample_loss(logit, label, weight)
+        loss = sample_loss.mean()
 
-        self.log('val_loss', loss, prog_bar=True, on_epoch=True, on_step=False)
-        if self.log_ind_loss:
-            self.v_sample_loss[sample_id] = loss
+        # logging, val_loss is logged once the shards of all ranks are gathered
+        self.val_losses.append(sample_loss.detach())
+        self.val_ids.extend(sample_id)
+        store = self._loss_store('val_loss_store')
+        if self.log_ind_loss and store is not None:
+            store.update(sample_id, sample_loss)
         if self.log_auc:
-            self.preds.append(torch.sigmoid(logit).squeeze(0))
-            self.lbl.append(label.squeeze(0))
+            self.preds.append(torch.sigmoid(logit))
+            self.lbl.append(label)
         return loss
 
 # log sample losses til neptune VIRKER IKKE LIGE NU - det er under validation step. Skal bruge mean loss
 # kan bare bruge den fra neptune-contrib
 #         if loss < self.best_val_loss:
 #             self.trainer.logger.log_artifact(export_pickle(
-#                 self.t_sample_loss), "t_sample_loss.pkl")
+#                 self._loss_store("loss_store").as_dict()), "t_sample_loss.pkl")
 #             self.trainer.logger.log_artifact(export_pickle(
-#                 self.v_sample_loss), "v_sample_loss.pkl")
+#                 self._loss_store("val_loss_store").as_dict()), "v_sample_loss.pkl")
 #             self.best_val_loss = loss
 
     def on_validation_epoch_start(self):
+        self.val_losses = []
+        self.val_ids = []
         if self.log_auc:
             self.preds = []
             self.lbl = []
 
     def on_validation_epoch_end(self):
+        # with DDP every rank holds a shard, the metrics need all of the cases.
+        # The shards are padded with repeated cases (ShardSampler), only one
+        # copy of each case is kept
+        keep = slice(None)
+        val_ds = getattr(getattr(self.trainer, 'datamodule', None), 'val_ds', None)
+        if val_ds is not None and dist.is_available() and dist.is_initialized():
+            pos = torch.as_tensor([val_ds.case_idx[id] for id in self.val_ids],
+                                  device=self.device)
+            keep = _first_of_each(_all_gather(pos))
+        self.log('val_loss', _all_gather(torch.cat(self.val_losses))[keep].mean(),
+                 prog_bar=True)
+        store = self._loss_store('val_loss_store')
+        if self.log_ind_loss and store is not None:
+            store.sync()
         if self.log_auc:
-            self.log('val_auc', auroc(torch.cat(self.preds), torch.cat(self.lbl), pos_label=1),
-                     prog_bar=True, on_epoch=True)
+            preds = _all_gather(torch.cat(self.preds))[keep]
+            lbl = _all_gather(torch.cat(self.lbl))[keep]
+            aucs = [auroc(preds[:, i], lbl[:, i], pos_label=1)
+                    for i in range(preds.shape[1])]
+            if self.diagnoses:
+                for diagnosis, auc in zip(self.diagnoses, aucs):
+                    self.log(f'val_auc_{diagnosis}', auc, on_epoch=True)
+            self.log('val_auc', torch.stack(aucs).mean(), prog_bar=True, on_epoch=True)
 
     def _unfreeze(self, module, idx):
         for param in module[idx:].parameters():
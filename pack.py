@@ -0,0 +1,80 @@
+# %%
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+# A pack is one flat binary shard holding many arrays of the same dtype plus a
+# json index mapping key -> (element offset, shape). Reads go through np.memmap
+# so only the touched pages are loaded and the page cache is shared between
+# processes.
+
+
+def write_pack(path, arrays, dtype=np.uint8):
+    index = {}
+    offset = 0
+    with open(path + '.tmp', 'wb') as f:
+        for key, arr in arrays:
+            arr = np.ascontiguousarray(arr, dtype=dtype)
+            f.write(arr.tobytes())
+            index[key] = [offset, list(arr.shape)]
+            offset += arr.size
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump({'dtype': np.dtype(dtype).str, 'entries': index}, f)
+    os.replace(path + '.tmp', path)
+    os.replace(path + '.json.tmp', path + '.json')
+    return index
+
+
+def read_index(path):
+    with open(path + '.json', 'r') as f:
+        return json.load(f)
+
+
+def open_pack(path, index=None):
+    if index is None:
+        index = read_index(path)
+    if not index['entries']:  # np.memmap refuses empty files
+        return np.empty(0, dtype=index['dtype'])
+    return np.memmap(path, dtype=index['dtype'], mode='r')
+
+
+def read_entry(pack, index, key):
+    offset, shape = index['entries'][key]
+    return pack[offset:offset + int(np.prod(shape))].reshape(shape)  # zero-copy
+
+
+def pack_path(datadir, stage):
+    return f'{datadir}/{stage}.pack'
+
+
+def pack_stage(datadir, stage, planes=['axial', 'sagittal', 'coronal']):
+    ids = set()
+    for fname in os.listdir(datadir):
+        if fname.startswith(f'{stage}-') and fname.endswith('.csv'):
+            with open(f'{datadir}/{fname}', 'r') as f:
+                ids.update(row[0] for row in csv.reader(f))
+
+    def arrays():
+        for plane in planes:
+            for id in sorted(ids):
+                yield f'{plane}/{id}', np.load(f'{datadir}/{stage}/{plane}/{id}.npy')
+
+    return write_pack(pack_path(datadir, stage), arrays())
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pack every case/plane of a stage into one uint8 shard.')
+    parser.add_argument('datadir')
+    parser.add_argument('--stages', nargs='+', default=['train', 'valid'])
+    parser.add_argument('--planes', nargs='+',
+                        default=['axial', 'sagittal', 'coronal'])
+    args = parser.parse_args()
+
+    for stage in args.stages:
+        index = pack_stage(args.datadir, stage, args.planes)
+        print(f'{stage}: packed {len(index)} volumes into {pack_path(args.datadir, stage)}')
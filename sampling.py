@@ -0,0 +1,136 @@
+# %%
+import math
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+# Per-case training losses in one fixed size tensor, indexed by dataset
+# position, and a sampler that oversamples the cases with the highest loss
+# while keeping the classes balanced. MRKnee writes to the store of
+# trainer.datamodule; the sampler reads it once at the start of every epoch.
+# Under DDP every rank writes the losses of its own cases and LossStore.sync
+# merges them, so all ranks draw from the same weights.
+
+
+class LossStore():
+    def __init__(self, case_idx, momentum=0.0):
+        self.case_idx = case_idx  # id -> dataset position, as MRDS.case_idx
+        self.ids = list(case_idx)
+        self.momentum = momentum  # >0 for an exponential moving average
+        self.losses = torch.full((len(case_idx),), float('nan'))
+        self.counts = torch.zeros(len(case_idx), dtype=torch.int64)
+        self.fresh = torch.zeros(len(case_idx), dtype=torch.int64)  # updates since sync
+
+    def update(self, ids, losses):
+        idx = torch.as_tensor([self.case_idx[id] for id in ids])
+        losses = losses.detach().float().cpu()
+        old = self.losses[idx]
+        if self.momentum:
+            losses = torch.where(torch.isnan(old), losses,
+                                 self.momentum * old + (1 - self.momentum) * losses)
+        self.losses[idx] = losses
+        self.counts[idx] += 1
+        self.fresh[idx] += 1
+
+    def sync(self):
+        # merges the updates of all ranks since the last sync, a case seen on
+        # several ranks gets the mean of their losses
+        if dist.is_available() and dist.is_initialized():
+            device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+            seen = (self.fresh > 0).float()
+            total = torch.where(seen > 0, self.losses, torch.zeros_like(self.losses))
+            stacked = torch.stack([total, seen, self.fresh.float()]).to(device)
+            dist.all_reduce(stacked)
+            total, seen, fresh = stacked.cpu()
+            self.losses = torch.where(seen > 0, total / seen.clamp(min=1), self.losses)
+            self.counts += fresh.long() - self.fresh
+        self.fresh.zero_()
+
+    def as_dict(self):
+        # {id: loss} of the seen cases, e.g. for utils.print_top_losses
+        seen = (self.counts > 0).nonzero().flatten().tolist()
+        return {self.ids[i]: self.losses[i].item() for i in seen}
+
+    def __len__(self):
+        return len(self.losses)
+
+
+class HardExampleSampler(Sampler):
+    # Every class gets the same share of the draws. Within a class a case is
+    # drawn with probability ~ loss ** hardness, so hardness=0 is plain class
+    # balancing. Cases without a loss yet count as the hardest of their class.
+    def __init__(self, labels, loss_store, num_samples=None, hardness=1.0,
+                 replacement=True, generator=None):
+        self.labels = torch.as_tensor(labels)
+        self.loss_store = loss_store
+        self.num_samples = num_samples or len(self.labels)
+        self.hardness = hardness
+        self.replacement = replacement
+        self.generator = generator
+
+    def weights(self):
+        losses = self.loss_store.losses.clone()
+        weights = torch.empty_like(losses)
+        classes = self.labels.unique()
+        for c in classes:
+            mask = self.labels == c
+            cls_losses = losses[mask]
+            seen = ~torch.isnan(cls_losses)
+            fill = cls_losses[seen].max() if seen.any() else 1.0
+            cls_losses[~seen] = fill
+            w = (cls_losses.clamp(min=1e-6)) ** self.hardness
+            weights[mask] = w / w.sum() / len(classes)
+        return weights
+
+    def __iter__(self):
+        idx = torch.multinomial(self.weights(), self.num_samples, self.replacement,
+                                generator=self.generator)
+        return iter(idx.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class DistributedHardExampleSampler(HardExampleSampler):
+    # every rank draws the same sequence from a generator seeded with the
+    # epoch and keeps every num_replicas-th sample, equal counts per rank
+    def __init__(self, labels, loss_store, num_samples=None, hardness=1.0,
+                 num_replicas=None, rank=None, seed=0):
+        super().__init__(labels, loss_store, num_samples, hardness)
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.seed = seed
+        self.epoch = 0
+        self.per_rank = math.ceil(self.num_samples / self.num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        idx = torch.multinomial(self.weights(), self.per_rank * self.num_replicas,
+                                self.replacement, generator=g)
+        return iter(idx[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.per_rank
+
+
+class ShardSampler(Sampler):
+    # in order and padded like DistributedSampler by wrapping around, so every
+    # rank runs the same number of batches, at least one. The padding repeats
+    # cases, MRKnee keeps one copy of each case when gathering the outputs
+    def __init__(self, n, num_replicas=None, rank=None):
+        self.n = n
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.per_rank = math.ceil(n / self.num_replicas)
+
+    def __iter__(self):
+        total = self.per_rank * self.num_replicas
+        return iter([i % self.n for i in range(self.rank, total, self.num_replicas)])
+
+    def __len__(self):
+        return self.per_rank
@@ -0,0 +1,78 @@
+# %%
+import argparse
+import csv
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from dataset import prep_volume
+
+# Scores a directory of cases ({casedir}/{plane}/{id}.npy) with a model from
+# export.py. Only needs torch and numpy:
+#   python score.py acl.pt data/valid --out acl_valid.csv --threads 8
+
+
+def load_model(path):
+    extra = {'meta.json': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+    return model.eval(), json.loads(extra['meta.json'])
+
+
+def load_case(casedir, id, meta):
+    return [prep_volume(np.load(f'{casedir}/{plane}/{id}.npy'),
+                        meta['mean'], meta['sd'], meta['crop'], meta['n_chans'])
+            for plane in meta['planes']]
+
+
+def score_dir(model, meta, casedir, batch_size=8, io_threads=2):
+    ids = sorted(fname[:-4] for fname in os.listdir(f'{casedir}/{meta["planes"][0]}')
+                 if fname.endswith('.npy'))
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    preds = np.empty((len(ids), len(meta['planes'])), dtype=np.float32)
+
+    def load_batch(batch):
+        cases = [load_case(casedir, id, meta) for id in batch]
+        imgs = [torch.cat([case[i] for case in cases]) for i in range(len(meta['planes']))]
+        n_slices = [[case[i].shape[0] for case in cases] for i in range(len(meta['planes']))]
+        return imgs, n_slices
+
+    # the next io_threads batches are read and preprocessed while the model runs
+    with ThreadPoolExecutor(io_threads) as pool, torch.no_grad():
+        pending = deque(pool.submit(load_batch, b) for b in batches[:io_threads])
+        i = 0
+        for batch in batches[io_threads:] + [None] * len(pending):
+            imgs, n_slices = pending.popleft().result()
+            if batch is not None:
+                pending.append(pool.submit(load_batch, batch))
+            out = model(imgs, n_slices).numpy()
+            preds[i:i + len(out)] = out
+            i += len(out)
+    return ids, preds
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score a directory of cases on CPU.')
+    parser.add_argument('model')
+    parser.add_argument('casedir')
+    parser.add_argument('--out', default='preds.csv')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='intra-op threads, defaults to torch\'s choice')
+    parser.add_argument('--io-threads', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, meta = load_model(args.model)
+    ids, preds = score_dir(model, meta, args.casedir, args.batch_size, args.io_threads)
+
+    with open(args.out, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ids'] + meta['planes'] + ['mean'])
+        for id, p in zip(ids, preds):
+            writer.writerow([id] + [f'{v:.6f}' for v in p] + [f'{p.mean():.6f}'])
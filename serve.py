@@ -0,0 +1,175 @@
+# %%
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from dataset import prep_volume
+from stats import NORM_STATS
+
+# Local scoring server. The plane models stay loaded in an infer.Predictor and
+# incoming cases are coalesced into micro-batches of up to max_batch cases or
+# whatever arrived within max_delay_ms of the first one. The protocol is one
+# json object per line over TCP:
+#   -> {"id": "0001", "casedir": "data/valid"}  or  {"id": ..., "paths": {plane: path}}
+#   <- {"id": "0001", "probs": {plane: p}, "score": mean of the plane probs}
+# Run it with `python serve.py serve acl` and query it with
+# `python serve.py client data/valid`.
+
+
+class BatchingServer():
+    def __init__(self, predictor, max_batch=8, max_delay_ms=10, io_threads=4):
+        self.predictor = predictor
+        self.planes = predictor.planes
+        self.mean, self.sd = NORM_STATS['global']  # as in get_preds
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.io_pool = ThreadPoolExecutor(io_threads)
+        self.model_pool = ThreadPoolExecutor(1)
+
+    def load_case(self, req):
+        paths = req.get('paths') or {plane: f'{req["casedir"]}/{plane}/{req["id"]}.npy'
+                                     for plane in self.planes}
+        return [prep_volume(np.load(paths[plane]), self.mean, self.sd)
+                for plane in self.planes]
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            cases = [case for case, _ in batch]
+            try:  # e.g. volumes of different H/W in one batch only fail that batch
+                imgs = [torch.cat([case[i] for case in cases]) for i in range(len(self.planes))]
+                n_slices = [torch.as_tensor([case[i].shape[0] for case in cases])
+                            for i in range(len(self.planes))]
+                preds = await loop.run_in_executor(
+                    self.model_pool, self.predictor.predict_batch, imgs, n_slices)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), p in zip(batch, preds):
+                if not fut.done():  # client went away
+                    fut.set_result(p)
+
+    async def score(self, line):
+        loop = asyncio.get_running_loop()
+        req = {}
+        try:
+            req = json.loads(line)
+            case = await loop.run_in_executor(self.io_pool, self.load_case, req)
+            fut = loop.create_future()
+            await self.queue.put((case, fut))
+            p = await fut
+            return {'id': req.get('id'),
+                    'probs': dict(zip(self.planes, p.tolist())),
+                    'score': float(p.mean())}
+        except Exception as e:
+            return {'id': req.get('id'), 'error': repr(e)}
+
+    async def handle(self, reader, writer):
+        # requests on one connection are scored concurrently, so a client can
+        # pipeline cases; responses carry the id and may come back out of order
+        async def respond(line):
+            resp = await self.score(line)
+            writer.write((json.dumps(resp) + '\n').encode())
+            await writer.drain()
+
+        tasks = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tasks.append(asyncio.ensure_future(respond(line)))
+            await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'serving {self.predictor.diagnosis} on {host}:{port}')
+        # stop serving if the batcher dies, queued requests would wait forever
+        batcher.add_done_callback(lambda task: task.cancelled() or server.close())
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            if not batcher.done():
+                raise
+        finally:
+            batcher.cancel()
+        if batcher.done() and not batcher.cancelled() and batcher.exception():
+            raise RuntimeError('batcher stopped') from batcher.exception()
+
+
+async def request_scores(reqs, host='127.0.0.1', port=8765):
+    # test client: pipelines all requests on one connection -> {id: response}
+    reader, writer = await asyncio.open_connection(host, port)
+    for req in reqs:
+        writer.write((json.dumps(req) + '\n').encode())
+    await writer.drain()
+    writer.write_eof()
+    resps = {}
+    for _ in reqs:
+        resp = json.loads(await reader.readline())
+        resps[resp['id']] = resp
+    writer.close()
+    return resps
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dynamic batching MRKnee scoring server')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_serve = sub.add_parser('serve')
+    p_serve.add_argument('diagnosis')
+    p_serve.add_argument('--ckpt-dir', default='models/')
+    p_serve.add_argument('--planes', nargs='+', default=['axial', 'sagittal', 'coronal'])
+    p_serve.add_argument('--backbones', nargs='+',
+                         default=['efficientnet_b0', 'efficientnet_b0', 'efficientnet_b0'])
+    p_serve.add_argument('--device', default='cpu')
+    p_serve.add_argument('--max-batch', type=int, default=8)
+    p_serve.add_argument('--max-delay-ms', type=float, default=10)
+    p_serve.add_argument('--threads', type=int, default=None)
+    p_client = sub.add_parser('client')
+    p_client.add_argument('casedir')
+    p_client.add_argument('--ids', nargs='*', default=None,
+                          help='defaults to every case in casedir')
+    for p in (p_serve, p_client):
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.cmd == 'serve':
+        from infer import Predictor
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        predictor = Predictor(args.diagnosis, args.planes, args.ckpt_dir,
+                              args.backbones, args.device)
+        server = BatchingServer(predictor, args.max_batch, args.max_delay_ms)
+        asyncio.run(server.serve(args.host, args.port))
+    else:
+        ids = args.ids or sorted(f[:-4] for f in os.listdir(f'{args.casedir}/axial')
+                                 if f.endswith('.npy'))
+        reqs = [{'id': id, 'casedir': args.casedir} for id in ids]
+        resps = asyncio.run(request_scores(reqs, args.host, args.port))
+        for id in ids:
+            print(json.dumps(resps[id]))
@@ -0,0 +1,59 @@
+# %%
+import multiprocessing as mp
+
+import torch
+
+# Decoded uint8 volumes in one shared memory arena. The cache has to be created
+# in the main process before the DataLoader workers start; the arena and the
+# slot table are shared tensors, so a volume put by one worker is read by every
+# other worker and survives worker restarts between epochs. Volumes are placed
+# first-fit and the least recently used ones are evicted once the byte budget
+# is used up.
+
+
+class VolumeCache():
+    def __init__(self, capacity, n_keys):
+        self.capacity = int(capacity)
+        self.arena = torch.empty(self.capacity, dtype=torch.uint8).share_memory_()
+        # per key: offset (-1 if not cached), nbytes, last use, S, H, W
+        self.table = torch.full((n_keys, 6), -1, dtype=torch.int64).share_memory_()
+        self.clock = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+
+    def get(self, key):
+        with self.lock:
+            offset, nbytes, _, s, h, w = self.table[key].tolist()
+            if offset < 0:
+                return None
+            self.clock += 1
+            self.table[key, 2] = self.clock[0]
+            # copy out, the slot can be evicted as soon as the lock is released
+            return self.arena[offset:offset + nbytes].numpy().reshape(s, h, w).copy()
+
+    def put(self, key, imgs):
+        if imgs.nbytes > self.capacity:
+            return
+        with self.lock:
+            if self.table[key, 0] >= 0:  # another worker was faster
+                return
+            offset = self._alloc(imgs.nbytes)
+            self.arena[offset:offset + imgs.nbytes].numpy()[:] = imgs.reshape(-1)
+            self.clock += 1
+            self.table[key] = torch.as_tensor(
+                [offset, imgs.nbytes, int(self.clock[0]), *imgs.shape])
+
+    def _alloc(self, nbytes):
+        while True:
+            used = self.table[self.table[:, 0] >= 0]
+            start = 0
+            for offset, size in used[used[:, 0].argsort(), :2].tolist():
+                if offset - start >= nbytes:
+                    return start
+                start = offset + size
+            if self.capacity - start >= nbytes:
+                return start
+            present = (self.table[:, 0] >= 0).nonzero().squeeze(1)
+            self.table[present[self.table[present, 2].argmin()]] = -1
+
+    def __len__(self):
+        return int((self.table[:, 0] >= 0).sum())
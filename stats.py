@@ -0,0 +1,108 @@
+# %%
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+# Per-plane and global mean/std of the min-max scaled volumes MRDS feeds the
+# model. Every worker reduces one .npy to float64 (count, mean, M2) moments,
+# which are merged with Chan's parallel update, so the result does not depend
+# on file order and never sums squares in low precision.
+
+# defaults for the MRNet train set, (mean, sd)
+NORM_STATS = {'axial': (66.4869, 60.8146),
+              'sagittal': (60.0440, 48.3106),
+              'coronal': (61.9277, 64.2818),
+              'global': (58.09, 49.73)}
+
+
+def volume_moments(path, crop=None, skip_zeros=False):
+    imgs = np.load(path).astype(np.float64)
+    imgs = (imgs - imgs.min()) / (imgs.max() - imgs.min()) * 255
+    if crop:
+        h, w = imgs.shape[1:]
+        y, x = (h - crop) // 2, (w - crop) // 2
+        imgs = imgs[:, y:y + crop, x:x + crop]
+    if skip_zeros:
+        imgs = imgs[imgs != 0]
+    if imgs.size == 0:
+        return 0, 0.0, 0.0
+    mean = imgs.mean()
+    return imgs.size, mean, np.square(imgs - mean).sum()
+
+
+def merge_moments(a, b):
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+
+def _job(args):
+    plane, path, crop, skip_zeros = args
+    return plane, volume_moments(path, crop, skip_zeros)
+
+
+def calc_stats(datadir,
+               stages=['train'],
+               planes=['axial', 'sagittal', 'coronal'],
+               crop=None,
+               skip_zeros=False,
+               processes=None):
+    jobs = [(plane, f'{datadir}/{stage}/{plane}/{fname}', crop, skip_zeros)
+            for stage in stages
+            for plane in planes
+            for fname in sorted(os.listdir(f'{datadir}/{stage}/{plane}'))
+            if fname.endswith('.npy')]
+
+    moments = {plane: (0, 0.0, 0.0) for plane in planes}
+    with Pool(processes) as pool:
+        for plane, m in pool.imap_unordered(_job, jobs, chunksize=8):
+            moments[plane] = merge_moments(moments[plane], m)
+
+    moments['global'] = (0, 0.0, 0.0)
+    for plane in planes:
+        moments['global'] = merge_moments(moments['global'], moments[plane])
+
+    return {plane: {'mean': float(mean), 'std': float(np.sqrt(m2 / n)), 'count': int(n)}
+            for plane, (n, mean, m2) in moments.items()}
+
+
+def save_stats(stats, path):
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=2)
+
+
+def load_stats(path):
+    # -> {plane: (mean, sd)} in the same layout as NORM_STATS
+    with open(path, 'r') as f:
+        stats = json.load(f)
+    return {plane: (s['mean'], s['std']) for plane, s in stats.items()}
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compute per-plane and global normalization stats for MRDS.')
+    parser.add_argument('datadir')
+    parser.add_argument('--out', default=None,
+                        help='defaults to {datadir}/norm_stats.json')
+    parser.add_argument('--stages', nargs='+', default=['train'])
+    parser.add_argument('--planes', nargs='+',
+                        default=['axial', 'sagittal', 'coronal'])
+    parser.add_argument('--crop', type=int, default=None,
+                        help='center crop size, matching the training transforms')
+    parser.add_argument('--skip-zeros', action='store_true')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    stats = calc_stats(args.datadir, args.stages, args.planes,
+                       args.crop, args.skip_zeros, args.processes)
+    save_stats(stats, args.out or f'{args.datadir}/norm_stats.json')
+    for plane, s in stats.items():
+        print(f"{plane}: mean {s['mean']:.4f} std {s['std']:.4f}")
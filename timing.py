@@ -0,0 +1,68 @@
+# %%
+import multiprocessing as mp
+import queue
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+# Opt-in per-stage timers for the data and model hot paths. Records made in
+# DataLoader workers are shipped to the main process once per sample through a
+# queue; callbacks.StageTimingCallback collects and logs them.
+
+
+class StageTimer():
+    def __init__(self):
+        self.queue = mp.Queue()
+        self.samples = defaultdict(list)
+        self.pending = []
+
+    @contextmanager
+    def __call__(self, stage, device=None):
+        t0 = time.perf_counter()
+        yield
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)  # time the kernels, not the launch
+        self.pending.append((stage, time.perf_counter() - t0))
+
+    def flush(self):
+        if not self.pending:
+            return
+        if get_worker_info() is None:
+            for stage, seconds in self.pending:
+                self.samples[stage].append(seconds)
+        else:
+            self.queue.cancel_join_thread()  # never block worker shutdown on us
+            self.queue.put(self.pending)
+        self.pending = []
+
+    def drain(self):
+        # main process: move worker records out of the queue so it stays short
+        self.flush()
+        while True:
+            try:
+                records = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            for stage, seconds in records:
+                self.samples[stage].append(seconds)
+
+    def collect(self):
+        self.drain()
+        samples, self.samples = self.samples, defaultdict(list)
+        return samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['samples'] = defaultdict(list)
+        state['pending'] = []
+        return state
+
+
+def summarize(samples):
+    return {f'{stage}_{q}_ms': float(np.percentile(seconds, p)) * 1000
+            for stage, seconds in samples.items()
+            for q, p in (('p50', 50), ('p95', 95))}
@@ -17,6 +17,7 @@ IMG_SZ = 240
 PLANES = ['axial']  # , 'sagittal', 'coronal'
 N_CHANS = 1
 DIAGNOSIS = 'acl'
+N_PROCS = 1  # >1 for data parallel training on CPU, one gloo process each
 
 data_args = {
     'datadir': 'data',
@@ -73,8 +74,13 @@ neptune_logger = pl_loggers.NeptuneLogger(
 # MODEL
 
 # TRAINER
-trainer = pl.Trainer(gpus=1,
-                     precision=16,
+if N_PROCS > 1:
+    # keep the datamodule's samplers, they shard the balanced sampling per rank
+    device_args = {'accelerator': 'ddp_cpu', 'num_processes': N_PROCS,
+                   'replace_sampler_ddp': False}
+else:
+    device_args = {'gpus': 1, 'precision': 16}
+trainer = pl.Trainer(**device_args,
                      limit_train_batches=10,
                      # max_epochs = 2,
                      # overfit_batches = 10,